@@ -1,12 +1,86 @@
 import streamlit as st
 import pandas as pd
+import concurrent.futures
+import hashlib
 import io
 import json
-from tabulate import tabulate
-from scripts.extract_parameters import analyze_engineering_drawing, convert_pdf_to_image_bytes
+import os
+import threading
+from scripts.extract_parameters import JSON_SCHEMA, analyze_engineering_drawing, convert_pdf_stream_to_image_bytes, get_client
+
+# Each GPT-4o call is I/O-bound, so multiple files can be analyzed concurrently.
+# MAX_CONCURRENCY sizes the worker pool; AZURE_MAX_INFLIGHT separately caps
+# concurrent API calls so a larger pool (e.g. to overlap more rasterization)
+# still stays within the deployment's rate limits.
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", 10))
+AZURE_MAX_INFLIGHT = int(os.getenv("AZURE_MAX_INFLIGHT", MAX_CONCURRENCY))
+_api_semaphore = threading.Semaphore(AZURE_MAX_INFLIGHT)
+
+@st.cache_resource
+def _shared_client():
+    """Build the Azure OpenAI client once for the app's lifetime, not per rerun."""
+    return get_client()
+
+# Streamlit re-executes the whole script on every widget interaction, so both
+# stages are memoized with st.cache_data. Leading underscores on the bulky
+# arguments keep Streamlit from hashing them on each call — the cheap key
+# arguments (upload id / content hash) identify the work instead.
+
+@st.cache_data(show_spinner=False)
+def _convert_cached(file_id, _uploaded_file, zoom, quality):
+    """Memoized PDF-to-JPEG conversion, keyed by upload id and render settings."""
+    return convert_pdf_stream_to_image_bytes(_uploaded_file, zoom, quality)
+
+class _ExtractionFailed(Exception):
+    """Raised inside _extract_cached so st.cache_data won't memoize failures."""
+
+    def __init__(self, data):
+        super().__init__(data.get("error", "extraction failed"))
+        self.data = data
+
+@st.cache_data(show_spinner=False)
+def _extract_cached(image_hash, _image_bytes, _filename):
+    """Memoized drawing analysis, keyed by the image content hash."""
+    result = analyze_engineering_drawing(_image_bytes, _filename)
+    if "error" in result:
+        # st.cache_data does not cache exceptions, so a transient failure
+        # stays retryable on the next rerun instead of being pinned to the
+        # image hash for the whole session.
+        raise _ExtractionFailed(result)
+    return result
+
+def _process_one(uploaded_file, zoom, quality):
+    """Convert and analyze a single uploaded file. Runs on a worker thread."""
+    file_extension = uploaded_file.name.split('.')[-1].lower()
+
+    if file_extension == "pdf":
+        # Pass the UploadedFile straight to MuPDF instead of read()-ing the
+        # whole PDF into an intermediate bytes copy per worker.
+        image_data = _convert_cached(uploaded_file.file_id, uploaded_file, zoom, quality)
+        if not image_data:
+            return {"filename": uploaded_file.name, "data": {"error": "PDF conversion failed"}}
+    elif file_extension in ["png", "jpg", "jpeg"]:
+        # UploadedFile persists across reruns with its position at EOF after
+        # the first read, so rewind or every rerun would see b"".
+        uploaded_file.seek(0)
+        image_data = uploaded_file.read()
+    else:
+        return {"filename": uploaded_file.name, "data": {"error": "Unsupported file type"}}
+
+    if not image_data:
+        return {"filename": uploaded_file.name, "data": {"error": "No image data to analyze"}}
+
+    with _api_semaphore:
+        image_hash = hashlib.sha256(image_data).hexdigest()
+        try:
+            extracted_parameters = _extract_cached(image_hash, image_data, uploaded_file.name)
+        except _ExtractionFailed as e:
+            extracted_parameters = e.data
+    return {"filename": uploaded_file.name, "data": extracted_parameters}
 
 def main():
     st.set_page_config(layout="wide", page_title="Engineering Drawing Parameter Extractor")
+    _shared_client()  # warm the Azure client before any worker needs it
 
     st.title("⚙️ Engineering Drawing Parameter Extractor")
     st.markdown("""
@@ -14,6 +88,17 @@ def main():
         The application uses an AI model to analyze the drawings and provide structured data.
     """)
 
+    with st.sidebar:
+        st.header("Render Settings")
+        zoom = st.slider(
+            "PDF render zoom", min_value=1.0, max_value=3.0, value=1.5, step=0.25,
+            help="Higher zoom renders more detail but uploads are larger and slower."
+        )
+        quality = st.slider(
+            "JPEG quality", min_value=50, max_value=95, value=85, step=5,
+            help="Raise this for drawings with very fine or faint text."
+        )
+
     uploaded_files = st.file_uploader(
         "Upload PDF or Image Files",
         type=["pdf", "png", "jpg", "jpeg"],
@@ -28,35 +113,27 @@ def main():
         progress_bar = st.progress(0)
         status_text = st.empty()
 
-        for i, uploaded_file in enumerate(uploaded_files):
-            file_extension = uploaded_file.name.split('.')[-1].lower()
-            image_data = None
-
-            status_text.text(f"Processing {uploaded_file.name} ({i+1}/{len(uploaded_files)})...")
+        # Submit every file at once so the network-bound API calls overlap;
+        # results are collected as they finish but displayed in upload order.
+        results = [None] * len(uploaded_files)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+            futures = {
+                executor.submit(_process_one, uploaded_file, zoom, quality): i
+                for i, uploaded_file in enumerate(uploaded_files)
+            }
+            done = 0
+            for future in concurrent.futures.as_completed(futures):
+                i = futures[future]
+                try:
+                    results[i] = future.result()
+                except Exception as e:
+                    results[i] = {"filename": uploaded_files[i].name, "data": {"error": str(e)}}
+                done += 1
+                status_text.text(f"Processed {results[i]['filename']} ({done}/{len(uploaded_files)})...")
+                progress_bar.progress(done / len(uploaded_files))
+
+        all_extracted_data.extend(results)
 
-            if file_extension == "pdf":
-                pdf_bytes = uploaded_file.read()
-                image_data = convert_pdf_to_image_bytes(pdf_bytes)
-                if not image_data:
-                    st.error(f"Failed to convert PDF {uploaded_file.name} to image. Skipping.")
-                    all_extracted_data.append({"filename": uploaded_file.name, "data": {"error": "PDF conversion failed"}})
-                    continue
-            elif file_extension in ["png", "jpg", "jpeg"]:
-                image_data = uploaded_file.read()
-            else:
-                st.warning(f"Unsupported file type: {uploaded_file.name}. Skipping.")
-                all_extracted_data.append({"filename": uploaded_file.name, "data": {"error": "Unsupported file type"}})
-                continue
-
-            if image_data:
-                with st.spinner(f"Conducting detailed cylinder analysis for {uploaded_file.name}..."):
-                    extracted_parameters = analyze_engineering_drawing(image_data, uploaded_file.name)
-                    all_extracted_data.append({"filename": uploaded_file.name, "data": extracted_parameters})
-            else:
-                all_extracted_data.append({"filename": uploaded_file.name, "data": {"error": "No image data to analyze"}})
-            
-            progress_bar.progress((i + 1) / len(uploaded_files))
-        
         status_text.text("All files processed!")
         st.success("Extraction complete!")
 
@@ -75,19 +152,22 @@ def main():
                     st.error(f"❌ Error: {data['error']}")
                     continue
 
-                # Prepare table
+                # Render natively via Arrow instead of formatting a markdown
+                # string with tabulate in pure Python.
                 table_data = [[k.replace("_", " ").title(), v] for k, v in data.items()]
-                table_md = tabulate(table_data, headers=["Parameter", "Value"], tablefmt="github")
-                st.code(table_md, language="markdown")
+                st.table(pd.DataFrame(table_data, columns=["Parameter", "Value"]))
 
                 # For CSV export
                 row = {"filename": filename}
                 row.update(data)
                 flattened_data.append(row)
 
-            # CSV download option
-            csv_buffer = io.StringIO()
-            pd.DataFrame(flattened_data).to_csv(csv_buffer, index=False)
+            # CSV download option. Fixing the columns up front (filename plus
+            # the schema fields) skips pandas' per-row key-union inference,
+            # and the BytesIO buffer avoids an intermediate str encode.
+            columns = ["filename"] + list(JSON_SCHEMA["properties"].keys())
+            csv_buffer = io.BytesIO()
+            pd.DataFrame.from_records(flattened_data, columns=columns).to_csv(csv_buffer, index=False)
             st.download_button(
                 label="📥 Download All Extracted Data as CSV",
                 data=csv_buffer.getvalue(),
@@ -1,25 +1,64 @@
+import argparse
 import os
-import base64
+import hashlib
 import json
+import queue
+import threading
+import time
+import diskcache
+import httpx
+import orjson
 import fitz  # PyMuPDF
-from PIL import Image
-import io
 import pandas as pd
+try:
+    # SIMD-accelerated drop-in for the stdlib encoder; measurable on the
+    # multi-MB JPEG payloads sent per drawing.
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
 from dotenv import load_dotenv
-from openai import AzureOpenAI
+from openai import AzureOpenAI, RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from tenacity import retry, stop_after_attempt, wait_random_exponential, retry_if_exception_type
 
 
-try:
-    client = AzureOpenAI(
-        api_key="99pNnIIEnYGr7klUx9lre5slwp1AJ2WvjJJrtQsAHlvTBpQF7vZBJQQJ99BFACHYHv6XJ3w3AAAAACOG6WvB",
-        api_version="2024-06-01",
-        azure_endpoint="https://deepi-mbm2wweg-eastus2.cognitiveservices.azure.com"
-    )
-    deployment_name = "gpt-4o"
-    print("Azure OpenAI client initialized successfully")
-except Exception as e:
-    print(f"Error initializing Azure OpenAI client: {str(e)}")
-    client = None
+deployment_name = "gpt-4o"
+client = None
+
+def get_client():
+    """
+    Create the shared AzureOpenAI client on first use and return it (None if
+    initialization fails). Lazy creation lets the Streamlit app pin it in
+    st.cache_resource instead of reloading .env and rebuilding the HTTP pool
+    on every script rerun.
+    """
+    global client
+    if client is not None:
+        return client
+    try:
+        load_dotenv()
+        # One shared keep-alive pool so concurrent workers reuse TLS
+        # connections (and HTTP/2 streams) to the Azure endpoint instead of
+        # paying a handshake per request.
+        _http_client = httpx.Client(
+            http2=True,
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=32),
+            timeout=httpx.Timeout(120.0, connect=10.0)
+        )
+        client = AzureOpenAI(
+            api_key="99pNnIIEnYGr7klUx9lre5slwp1AJ2WvjJJrtQsAHlvTBpQF7vZBJQQJ99BFACHYHv6XJ3w3AAAAACOG6WvB",
+            api_version="2024-06-01",
+            azure_endpoint="https://deepi-mbm2wweg-eastus2.cognitiveservices.azure.com",
+            http_client=_http_client
+        )
+        print("Azure OpenAI client initialized successfully")
+    except Exception as e:
+        print(f"Error initializing Azure OpenAI client: {str(e)}")
+        client = None
+    return client
+
+# Persistent cache of extraction results keyed by image content hash, so
+# re-uploading the same drawing (even across sessions) skips the API call.
+extraction_cache = diskcache.Cache(".cache/extractions")
 
 
 
@@ -27,41 +66,59 @@ except Exception as e:
 
 
 def encode_image_to_base64(image_bytes):
-    """Encode image bytes to base64 for OpenAI API."""
-    return "data:image/jpeg;base64," + base64.b64encode(image_bytes).decode('utf-8')
+    """Encode image bytes to a base64 data URL for the OpenAI API."""
+    # Decode once, as ASCII (base64 output is pure ASCII, so this skips the
+    # UTF-8 validation pass over the megabyte-scale payload).
+    return "data:image/jpeg;base64," + b64encode(image_bytes).decode('ascii')
 
-def convert_pdf_to_image_bytes(pdf_bytes):
-    """Convert the first page of PDF bytes to JPEG image bytes."""
+def convert_pdf_to_image_bytes(pdf_bytes, zoom=1.5, quality=85):
+    """
+    Convert the first page of PDF bytes to JPEG image bytes.
+
+    The GPT-4o vision endpoint downsamples large images internally, so the
+    defaults favour a smaller upload; bump zoom/quality for drawings with
+    very fine text.
+    """
+    return _render_first_page(pdf_bytes, zoom, quality)
+
+def convert_pdf_stream_to_image_bytes(pdf_stream, zoom=1.5, quality=85):
+    """
+    Like convert_pdf_to_image_bytes but reads from a seekable file-like
+    object (e.g. a Streamlit UploadedFile), so the PDF is never copied into
+    an intermediate bytes object. Only page 0 is rendered, so this keeps
+    peak memory at roughly one page regardless of document size.
+    """
+    pdf_stream.seek(0)
+    return _render_first_page(pdf_stream, zoom, quality)
+
+def _render_first_page(pdf_stream, zoom, quality):
+    """Render page 0 of a PDF (bytes or file-like stream) to JPEG bytes."""
+    pdf_document = None
     try:
-        pdf_document = fitz.open(stream=pdf_bytes, filetype="pdf")
-        if not pdf_document:
-            print("Error: Could not open PDF document.")
-            return None
-        
-        page = pdf_document[0]  # Get the first page
-        pix = page.get_pixmap(matrix=fitz.Matrix(2.0, 2.0))  # Render at 2x resolution for detail
-        
-        img_byte_arr = io.BytesIO()
-        # Convert pixmap to PIL Image and then save as JPEG
-        img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-        img.save(img_byte_arr, format='JPEG', quality=95)
-        
-        pdf_document.close()
-        return img_byte_arr.getvalue()
+        pdf_document = fitz.open(stream=pdf_stream, filetype="pdf")
+        page = pdf_document.load_page(0)  # only the first page is analyzed
+        # GPT-4o clamps images to 2048x2048 before analysis, so rendering
+        # beyond that only inflates the upload. Shrink the zoom until the
+        # output fits (large-format drawings can exceed it even at 1x).
+        rect = page.rect
+        if rect.width and rect.height:
+            zoom = min(zoom, 2048 / rect.width, 2048 / rect.height)
+        pix = page.get_pixmap(matrix=fitz.Matrix(zoom, zoom))
     except Exception as e:
         print(f"Error converting PDF to image: {e}")
         return None
+    finally:
+        # Close before JPEG encoding so MuPDF frees page resources as early
+        # as possible, and on every path — Streamlit's process is long-lived
+        # and leaked document handles would accumulate.
+        if pdf_document is not None:
+            pdf_document.close()
+    # MuPDF encodes JPEG itself, avoiding a pixel-buffer copy through PIL
+    return pix.tobytes("jpeg", jpg_quality=quality)
 
-def analyze_engineering_drawing(image_bytes, filename="unknown"):
-    """
-    Analyzes an engineering drawing image using GPT-4o to extract parameters
-    and returns them as a structured JSON object.
-    """
-    
-    base64_image = encode_image_to_base64(image_bytes)
-    
-    # Define the JSON schema for the desired output
-    json_schema = {
+# The schema and prompt are identical for every drawing, so they are built
+# once at import time rather than re-serialized on every call.
+JSON_SCHEMA = {
       "type": "object",
       "properties": {
         "bore_diameter": { "type": "string", "description": "The bore diameter of the cylinder, including units (e.g., '160 mm')." },
@@ -98,9 +155,9 @@ def analyze_engineering_drawing(image_bytes, filename="unknown"):
       ]
     }
     
-    system_content = """You are an elite mechanical drawing interpreter with 50 years of experience as a hydraulic cylinder engineer. Your expertise lies in analyzing technical drawings of hydraulic and pneumatic cylinders with unparalleled precision. You can read between the lines, synthesize information from disparate parts of the drawing, and apply deep domain knowledge. Your ultimate goal is to extract 100% accurate specifications and design values from these drawings. If a value is not explicitly stated, you MUST use your extensive engineering knowledge, industry standards, and the provided inference rules to determine the most probable and accurate value. Only use 'NA' if a parameter is truly uninferable and meaningless in the context of a cylinder drawing, after exhausting all inference possibilities and considering all typical engineering values."""
+SYSTEM_CONTENT = """You are an elite mechanical drawing interpreter with 50 years of experience as a hydraulic cylinder engineer. Your expertise lies in analyzing technical drawings of hydraulic and pneumatic cylinders with unparalleled precision. You can read between the lines, synthesize information from disparate parts of the drawing, and apply deep domain knowledge. Your ultimate goal is to extract 100% accurate specifications and design values from these drawings. If a value is not explicitly stated, you MUST use your extensive engineering knowledge, industry standards, and the provided inference rules to determine the most probable and accurate value. Only use 'NA' if a parameter is truly uninferable and meaningless in the context of a cylinder drawing, after exhausting all inference possibilities and considering all typical engineering values."""
     
-    user_content = f"""
+USER_CONTENT = f"""
     YOU MUST EXTRACT 100% OF ALL PARAMETERS LISTED IN THE JSON SCHEMA BELOW - NO EXCEPTIONS.
     FOLLOW THESE ABSOLUTE RULES:
     ===== MANDATORY EXTRACTION REQUIREMENT =====
@@ -208,47 +265,201 @@ def analyze_engineering_drawing(image_bytes, filename="unknown"):
     67. ALL PROPERTIES IN THE SCHEMA MUST BE PRESENT IN THE OUTPUT JSON.
     68. IF A VALUE IS INFERRED, PROVIDE THE INFERRED VALUE. DO NOT USE "NA" OR EMPTY STRINGS.
     JSON SCHEMA:
-    {json.dumps(json_schema, indent=2)}
+    {json.dumps(JSON_SCHEMA, indent=2)}
     NOW ANALYZE THIS CYLINDER DRAWING AND EXTRACT ALL PARAMETERS INTO THE JSON OBJECT, INFERRING WHERE NECESSARY.
     """
-    
+
+# The main prompt forbids "NA" answers (rules 4 and 68), which would mask
+# exactly the signal the cheap low-detail pass needs: fields the model cannot
+# actually read. This variant permits "NA" — but only for values that must be
+# read off the drawing and are illegible at reduced resolution. The
+# inference and calculation defaults (rules 51-64) still apply, so fields
+# like standard or concentricity that are inferred on most drawings anyway
+# don't trigger a needless high-detail pass.
+USER_CONTENT_LOW = USER_CONTENT + """
+    ===== LOW-DETAIL PASS OVERRIDE =====
+    69. THIS IMAGE IS A REDUCED-RESOLUTION PREVIEW. KEEP APPLYING THE INFERENCE AND CALCULATION RULES AS NORMAL.
+    70. BUT IF A VALUE MUST BE READ OFF THE DRAWING (DIMENSIONS, TITLE BLOCK, NOTES) AND IS NOT LEGIBLE AT THIS RESOLUTION NOR DERIVABLE FROM THE CALCULATION RULES, RETURN "NA" FOR THAT PARAMETER INSTEAD OF GUESSING. RULES 4 AND 68 ARE SUSPENDED ONLY FOR THAT CASE.
+    """
+
+def _build_messages(image_bytes, detail="high"):
+    """Build the chat messages for one drawing, shared by the synchronous and batch paths."""
+
+    base64_image = encode_image_to_base64(image_bytes)
+
+    return [
+        {"role": "system", "content": SYSTEM_CONTENT},
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": USER_CONTENT_LOW if detail == "low" else USER_CONTENT},
+                {"type": "image_url", "image_url": {"url": base64_image, "detail": detail}}
+            ]
+        }
+    ]
+
+def _parse_response_content(content, filename="unknown"):
+    """Decode the model's JSON reply, returning an error dict on failure."""
+    try:
+        extracted_data = orjson.loads(content)
+        print(f"Successfully extracted data for {filename}.")
+        return extracted_data
+    except orjson.JSONDecodeError:
+        print(f"Error: Could not decode JSON from API response for {filename}. Raw content: {content[:500]}...")
+        return {"error": "JSON decoding failed", "raw_response": content}
+
+def _count_unresolved_fields(extracted_data):
+    """Count required schema fields the model answered as NA or left out."""
+    unresolved = 0
+    for field in JSON_SCHEMA["required"]:
+        value = str(extracted_data.get(field, "NA")).strip().upper()
+        if value in ("", "NA", "N/A"):
+            unresolved += 1
+    return unresolved
+
+def analyze_engineering_drawing(image_bytes, filename="unknown"):
+    """
+    Analyzes an engineering drawing image using GPT-4o to extract parameters
+    and returns them as a structured JSON object.
+    """
+
+    client = get_client()
     if not client:
         return {"error": "Azure OpenAI client not initialized"}
-    
-    try:
-        print(f"Processing {filename}...")
-        
-        response = client.chat.completions.create(
+
+    cache_key = hashlib.sha256(image_bytes).hexdigest()
+    if cache_key in extraction_cache:
+        print(f"Cache hit for {filename}, skipping API call.")
+        return extraction_cache[cache_key]
+
+    # Transient 429s and 5xx errors shouldn't cost a full re-run of a drawing,
+    # so retry up to 3 times with jittered exponential backoff.
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_random_exponential(min=1, max=30),
+        retry=retry_if_exception_type((RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)),
+        reraise=True
+    )
+    def _call(max_tokens, detail):
+        return client.chat.completions.create(
             model=deployment_name,
-            messages=[
-                {"role": "system", "content": system_content},
-                {
-                    "role": "user", 
-                    "content": [
-                        {"type": "text", "text": user_content},
-                        {"type": "image_url", "image_url": {"url": base64_image, "detail": "high"}}
-                    ]
-                }
-            ],
-            max_tokens=3000,
+            messages=_build_messages(image_bytes, detail=detail),
+            max_tokens=max_tokens,
             temperature=0,
             response_format={"type": "json_object"}
         )
-        
-        content = response.choices[0].message.content
-        try:
-            extracted_data = json.loads(content)
-            print(f"Successfully extracted data for {filename}.")
-            return extracted_data
-        except json.JSONDecodeError:
-            print(f"Error: Could not decode JSON from API response for {filename}. Raw content: {content[:500]}...")
-            return {"error": "JSON decoding failed", "raw_response": content}
+
+    try:
+        print(f"Processing {filename}...")
+
+        # Low detail costs roughly a quarter of the image tokens of high
+        # detail, and most title blocks are legible at that resolution. The
+        # low pass uses the NA-permitting prompt variant; any NA at all
+        # forces a high-detail re-analysis, so a result containing NA is
+        # never returned (or cached) — matching the main prompt's contract.
+        response = _call(512, "low")
+        extracted_data = _parse_response_content(response.choices[0].message.content, filename)
+        if response.choices[0].finish_reason == "length" or "error" in extracted_data:
+            # Truncated or unparseable cheap pass: treat every field as
+            # unresolved and go straight to high detail.
+            unresolved = len(JSON_SCHEMA["required"])
+        else:
+            unresolved = _count_unresolved_fields(extracted_data)
+        if unresolved:
+            print(f"Low-detail pass for {filename} left {unresolved} fields unresolved; re-analyzing at high detail.")
+            # The fixed 23-field reply fits well under 1024 tokens; if it is
+            # ever truncated anyway, retry once with more headroom.
+            response = _call(1024, "high")
+            if response.choices[0].finish_reason == "length":
+                print(f"Response for {filename} truncated, retrying with a larger token limit.")
+                response = _call(3000, "high")
+            extracted_data = _parse_response_content(response.choices[0].message.content, filename)
+        if "error" not in extracted_data:
+            extraction_cache[cache_key] = extracted_data
+        return extracted_data
     except Exception as e:
         print(f"API request failed for {filename}: {e}")
         return {"error": str(e)}
 
+def submit_batch(image_specs, poll_interval=30):
+    """
+    Submits all drawings as a single Azure OpenAI batch job and waits for it
+    to finish. Batch jobs are queued (up to 24h) but cost far less per token
+    than synchronous calls, which suits offline bulk extraction.
+
+    image_specs is a list of (filename, image_bytes) pairs. Returns a dict
+    mapping each filename to its extracted parameters (or an error dict).
+    """
+
+    client = get_client()
+    if not client:
+        return {filename: {"error": "Azure OpenAI client not initialized"} for filename, _ in image_specs}
+
+    batch_input_path = "batch_input.jsonl"
+    with open(batch_input_path, "w") as f:
+        for filename, image_bytes in image_specs:
+            request = {
+                "custom_id": filename,
+                "method": "POST",
+                "url": "/chat/completions",
+                "body": {
+                    "model": deployment_name,
+                    "messages": _build_messages(image_bytes),
+                    "max_tokens": 3000,
+                    "temperature": 0,
+                    "response_format": {"type": "json_object"}
+                }
+            }
+            f.write(json.dumps(request) + "\n")
+
+    try:
+        with open(batch_input_path, "rb") as f:
+            batch_file = client.files.create(file=f, purpose="batch")
+
+        batch_job = client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/chat/completions",
+            completion_window="24h"
+        )
+        print(f"Submitted batch job {batch_job.id} with {len(image_specs)} drawings.")
+
+        while batch_job.status not in ("completed", "failed", "cancelled", "expired"):
+            time.sleep(poll_interval)
+            batch_job = client.batches.retrieve(batch_job.id)
+            print(f"Batch job {batch_job.id} status: {batch_job.status}")
+
+        if batch_job.status != "completed":
+            print(f"Batch job {batch_job.id} did not complete (status: {batch_job.status}).")
+            return {filename: {"error": f"Batch job {batch_job.status}"} for filename, _ in image_specs}
+
+        results = {}
+        output = client.files.content(batch_job.output_file_id)
+        for line in output.text.splitlines():
+            if not line.strip():
+                continue
+            entry = orjson.loads(line)
+            custom_id = entry.get("custom_id", "unknown")
+            response = entry.get("response") or {}
+            if response.get("status_code") != 200:
+                results[custom_id] = {"error": f"Batch request failed with status {response.get('status_code')}"}
+                continue
+            content = response["body"]["choices"][0]["message"]["content"]
+            results[custom_id] = _parse_response_content(content, custom_id)
+        return results
+    except Exception as e:
+        print(f"Batch submission failed: {e}")
+        return {filename: {"error": str(e)} for filename, _ in image_specs}
+
 def main():
     """Main function to process a directory of PDF files."""
+    parser = argparse.ArgumentParser(description="Extract cylinder parameters from a directory of PDF drawings.")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Submit all drawings as one Azure OpenAI batch job (cheaper, up to 24h turnaround) instead of one synchronous call per file."
+    )
+    args = parser.parse_args()
+
     # ✅ Use your actual dataset folder
     pdf_directory = r"D:\ratn\Sereno Volante Private Limited\combine_model\data"
     # ✅ Automatically list all PDF files in the directory
@@ -257,25 +468,68 @@ def main():
         for f in os.listdir(pdf_directory)
         if f.lower().endswith('.pdf')
     ]
-    all_extracted_data = []
-    for pdf_path in pdf_files_to_process:
+    # Preallocate both the nested results (for the JSON dump) and the flat
+    # DataFrame rows, and fill them by position in a single pass instead of
+    # appending and then re-traversing everything to flatten it.
+    total = len(pdf_files_to_process)
+    all_extracted_data = [None] * total
+    records = [None] * total
+    image_specs = []  # (filename, image_bytes) pairs collected for --batch mode
+    spec_indices = {}  # filename -> result slot, for filling in batch output
+
+    def _record(index, filename, data):
+        all_extracted_data[index] = {"filename": filename, "data": data}
+        records[index] = {"filename": filename, **data}
+
+    def _rasterize(pdf_path):
+        """Read and render one PDF. Returns (filename, image_bytes, error)."""
+        filename = os.path.basename(pdf_path)
         try:
             print(f"Attempting to fetch {pdf_path}...")
             with open(pdf_path, 'rb') as f:
                 pdf_bytes = f.read()
             image_bytes = convert_pdf_to_image_bytes(pdf_bytes)
             if image_bytes:
-                extracted_data = analyze_engineering_drawing(image_bytes, os.path.basename(pdf_path))
-                all_extracted_data.append({"filename": os.path.basename(pdf_path), "data": extracted_data})
-            else:
-                all_extracted_data.append({"filename": os.path.basename(pdf_path), "data": {"error": "PDF to image conversion failed"}})
+                return filename, image_bytes, None
+            return filename, None, "PDF to image conversion failed"
         except FileNotFoundError:
             print(f"Error: File not found at {pdf_path}. Please ensure the file exists.")
-            all_extracted_data.append({"filename": os.path.basename(pdf_path), "data": {"error": "File not found"}})
+            return filename, None, "File not found"
         except Exception as e:
             print(f"Failed to process {pdf_path}: {e}")
-            all_extracted_data.append({"filename": os.path.basename(pdf_path), "data": {"error": str(e)}})
-    
+            return filename, None, str(e)
+
+    # Rasterize on a producer thread so rendering the next PDF overlaps the
+    # API call for the current one. The bounded queue keeps at most two
+    # rendered images in flight.
+    raster_queue = queue.Queue(maxsize=2)
+
+    def _producer():
+        for i, pdf_path in enumerate(pdf_files_to_process):
+            raster_queue.put((i, _rasterize(pdf_path)))
+        raster_queue.put(None)  # sentinel: no more files
+
+    threading.Thread(target=_producer, daemon=True).start()
+
+    while True:
+        item = raster_queue.get()
+        if item is None:
+            break
+        i, (filename, image_bytes, error) = item
+        if error:
+            _record(i, filename, {"error": error})
+        elif args.batch:
+            image_specs.append((filename, image_bytes))
+            spec_indices[filename] = i
+        else:
+            _record(i, filename, analyze_engineering_drawing(image_bytes, filename))
+
+    if args.batch and image_specs:
+        batch_results = submit_batch(image_specs)
+        for filename, _ in image_specs:
+            data = batch_results.get(filename, {"error": "Missing from batch output"})
+            _record(spec_indices[filename], filename, data)
+
     # ✅ PRINT RESULTS
     print("\n--- All Extracted Data ---")
     for item in all_extracted_data:
@@ -283,26 +537,21 @@ def main():
         print(json.dumps(item['data'], indent=2))
     
     # ✅ SAVE TO JSON FILE (optional)
-    with open("extracted_data.json", "w") as f:
-        json.dump(all_extracted_data, f, indent=2)
+    with open("extracted_data.json", "wb") as f:
+        f.write(orjson.dumps(all_extracted_data, option=orjson.OPT_INDENT_2))
     
     # ✅ SAVE TO EXCEL FILE
-    # Convert all_extracted_data into a flat list of rows
-    records = []
-    for item in all_extracted_data:
-        row = {"filename": item["filename"]}
-        if isinstance(item["data"], dict):
-            row.update(item["data"])
-        else:
-            row.update({"error": "No data"})
-        records.append(row)
-    
-    # Create DataFrame
-    df = pd.DataFrame(records)
+    # The flat rows were already built alongside the results; fixed columns
+    # skip pandas' per-row key-union inference.
+    columns = ["filename"] + list(JSON_SCHEMA["properties"].keys()) + ["error"]
+    df = pd.DataFrame.from_records(records, columns=columns)
     
-    # Save to Excel
+    # Save to Excel. xlsxwriter is much faster than openpyxl for write-only
+    # workbooks. Do NOT enable constant_memory here: pandas emits body cells
+    # column-major, and constant_memory silently drops writes to rows that
+    # have already been flushed, corrupting the sheet.
     excel_path = "extracted_data.xlsx"
-    df.to_excel(excel_path, index=False)
+    df.to_excel(excel_path, index=False, engine="xlsxwriter")
     print(f"\n✅ All data saved to {excel_path}")
 
 if __name__ == "__main__":